@@ -6,3 +6,5 @@ step = _default.step
 add_environment_resources = _default.add_environment_resources
 resource_ready = _default.resource_ready
 resource = _default.resource
+run = _default.run
+compile = _default.compile
@@ -21,17 +21,166 @@ The return values of the executed step are returned.
 import asyncio
 import logging
 from collections import defaultdict
-from functools import wraps
 from inspect import signature
-from typing import Any, Callable, Dict, Sequence
+from typing import Any, Callable, Dict, Sequence, Set, Tuple
 
 _ENV = "!environment!"
 
+log = logging.getLogger(__name__)
+
 
 class PipelineError(Exception):
     pass
 
 
+class Step:
+    # A single step in a pipeline, wrapping the decorated function.
+    #
+    # The function signature is parsed once at decoration time and split into
+    # tuples of parameter names, so calling the step only loops over plain
+    # strings instead of touching inspect.Parameter objects on every call.
+    #
+    # Documented in a comment because __doc__ below must delegate to the
+    # wrapped function: __slots__ can't hold __doc__ next to a class
+    # docstring, and a property can.
+    __doc__ = property(lambda self: self.func.__doc__)
+
+    __slots__ = (
+        "pipe",
+        "func",
+        "fname",
+        "provides",
+        "_n_provides",
+        "_single",
+        "sig",
+        "wants",
+        "_var_positional",
+        "_keyword",
+        "_invoke",
+        "_plan",
+        "_order",
+        "__name__",
+        "__qualname__",
+        "__wrapped__",
+    )
+
+    def __init__(self, pipe, func, provides):
+        self.pipe = pipe
+        self.func = func
+        self.fname = func.__name__
+        # The attributes tooling actually reads; skips functools.wraps'
+        # full dict merge and attribute copy. __doc__ is handled by the
+        # class-level property above.
+        self.__name__ = func.__name__
+        self.__qualname__ = func.__qualname__
+        self.__wrapped__ = func
+        self.provides = tuple(provides)
+        self._n_provides = len(self.provides)
+        self._single = self.provides[0] if self._n_provides == 1 else None
+        self.sig = signature(func)  # kept for introspection only
+        self._var_positional = tuple(
+            name
+            for name, param in self.sig.parameters.items()
+            if param.kind is param.VAR_POSITIONAL
+        )
+        self._keyword = tuple(
+            name
+            for name, param in self.sig.parameters.items()
+            if param.kind is not param.VAR_POSITIONAL
+        )
+        self.wants = tuple(self.sig.parameters)
+        self._plan: Tuple["Step", ...] = None
+        self._order: Tuple["Step", ...] = None
+
+        if self._var_positional:
+            self._invoke = self._invoke_mixed
+        else:
+            # The common case - keyword resources only - gets a closure
+            # compiled here, so calling it is just gather + func(**kwargs)
+            # with no argument-partitioning logic left on the hot path.
+            kw_names = self._keyword
+
+            async def _invoke():
+                store = pipe._store
+                kwargs = {}
+                pending = []
+                for name in kw_names:
+                    fut = store.get(name)
+                    if fut is not None and fut.done():
+                        kwargs[name] = fut.result()
+                    else:
+                        pending.append(name)
+                if pending:
+                    values = await asyncio.gather(
+                        *(pipe.resource(name) for name in pending)
+                    )
+                    kwargs.update(zip(pending, values))
+                return await func(**kwargs)
+
+            self._invoke = _invoke
+
+    async def __call__(self, **resources):
+        return await self.pipe.run(self, **resources)
+
+    async def _execute(self):
+        """Run the wrapped function, assuming prerequisites are scheduled."""
+        pipe = self.pipe
+        store = pipe._store
+        for name in self.provides:
+            fut = store.get(name)
+            if fut is not None and fut.done():
+                log.debug("Resource cached, skipping %s", self.fname)
+                return
+
+        log.debug("calling %s", self.fname)
+        results = await self._invoke()
+        n = self._n_provides
+        if n == 0:
+            return results
+
+        if n == 1:
+            pipe._add_returned_resources(
+                _provider=self.fname, **{self._single: results}
+            )
+            return (results,)
+
+        if len(results) != n:
+            # TODO: support functions that want to add_resources during runtime
+            raise PipelineError(
+                f"Expected {self.fname} to return "
+                f"{n} value(s), but got {len(results)}"
+            )
+        resources = dict(zip(self.provides, results))
+        pipe._add_returned_resources(_provider=self.fname, **resources)
+
+        return results
+
+    async def _invoke_mixed(self):
+        """Collect resources and call the function, for steps taking *args.
+
+        Resources are usually resolved by the time a step runs; those are
+        pulled straight out of the finished Future, and whatever remains is
+        fetched with one gather so independent providers can overlap."""
+        pipe = self.pipe
+        store = pipe._store
+        values = {}
+        pending = []
+        for name in self.wants:
+            fut = store.get(name)
+            if fut is not None and fut.done():
+                values[name] = fut.result()
+            else:
+                pending.append(name)
+        if pending:
+            fetched = await asyncio.gather(
+                *(pipe.resource(name) for name in pending)
+            )
+            values.update(zip(pending, fetched))
+        args = [values[name] for name in self._var_positional]
+        kwargs = {name: values[name] for name in self._keyword}
+        return await self.func(*args, **kwargs)
+
+
 class Pipeline:
     """A pipeline is a series of steps that provide resources to one another.
 
@@ -40,10 +189,13 @@ class Pipeline:
     what resources need to be available for the step to be able to run."""
 
     def __init__(self, initial_resources: Dict[str, Any] = None):
-        self.log = logging.getLogger(__name__)
-        self._store: Dict[str, asyncio.Future] = defaultdict(asyncio.Future)
+        self.log = log
+        self._store: Dict[str, asyncio.Future] = {}
         self._steps: Dict[str, Callable] = {}
         self._provider: Dict[str, str] = {}
+        self._graph_cache: Dict[Tuple[str, frozenset], Tuple[Step, ...]] = {}
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._runtime_resources: Set[str] = set()
         if initial_resources:
             self.add_environment_resources(**initial_resources)
 
@@ -59,78 +211,246 @@ class Pipeline:
             provides = (provides,)
 
         def decorator(func):
-            func._provides = provides
-            func._wants = signature(func).parameters
-
             for resource in provides:
                 # TODO: if multiple steps provide a resource, what's the resolution order?
                 # For now, the first one to register gets dibs.
                 if resource not in self._provider:
                     self._provider[resource] = func.__name__
 
-            @wraps(func)
-            async def step_wrapper(**resources):
-                self.add_environment_resources(**resources)
-                if any(self.resource_ready(r) for r in func._provides):
-                    self.log.debug("Resource cached, skipping %s", func.__name__)
-                    return
-
-                args, kwargs = [], {}
-                for name, param in func._wants.items():
-                    value = await self.resource(name)
-                    if param.kind is param.VAR_POSITIONAL:
-                        args.append(value)
-                    else:
-                        kwargs[name] = value
+            step = Step(self, func, provides)
+            self._steps[func.__name__] = step
+            return step
 
-                self.log.debug("calling %s", func.__name__)
-                results = await func(*args, **kwargs)
-                if not func._provides:
-                    return results
+        return decorator
 
-                if len(func._provides) == 1:
-                    results = (results,)
+    def _call_graph(self, target) -> Tuple[Step, ...]:
+        """Return the steps that must run before {target}, in execution order.
 
-                if len(results) != len(func._provides):
-                    # TODO: support functions that want to add_resources during runtime
-                    raise PipelineError(
-                        f"Expected {func.__name__} to return "
-                        f"{len(func._provides)} value(s), but got {len(results)}"
-                    )
-                resources = dict(zip(func._provides, results))
-                self._add_returned_resources(_provider=func.__name__, **resources)
+        The graph is walked iteratively and the resulting order is materialized
+        as a tuple, cached per (step, missing resources) so repeated calls with
+        the same store state reuse it. Once a step has resolved its graph the
+        result is also memoized on the step itself; resources only accumulate
+        between clear() calls, so a memoized order can never miss a provider
+        that is still needed."""
+        order = target._order
+        if order is not None:
+            return order
 
-                return results
+        key = (
+            target.fname,
+            frozenset(
+                name for name in target.wants if not self.resource_ready(name)
+            ),
+        )
+        try:
+            order = target._order = self._graph_cache[key]
+            return order
+        except KeyError:
+            pass
 
-            self._steps[func.__name__] = step_wrapper
-            return step_wrapper
+        if target._plan is not None:
+            order = self._prune_plan(target._plan, key[1])
+            self._graph_cache[key] = order
+            target._order = order
+            return order
 
-        return decorator
+        order = []
+        seen = {target.fname}
+        stack = [(target, False)]
+        while stack:
+            step, expanded = stack.pop()
+            if expanded:
+                order.append(step)
+                continue
+            stack.append((step, True))
+            for name in step.wants:
+                if self.resource_ready(name):
+                    continue
+                provider = self._provider.get(name)
+                if provider is None or provider == _ENV or provider in seen:
+                    continue
+                seen.add(provider)
+                stack.append((self._steps[provider], False))
+
+        # The target itself comes out last; its caller runs it.
+        order = tuple(order[:-1])
+        self._graph_cache[key] = order
+        target._order = order
+        return order
+
+    def _prune_plan(self, plan, missing) -> Tuple[Step, ...]:
+        """Drop steps from a precompiled plan whose output is already stored.
+
+        Walks the plan dependents-first, keeping a step only if something
+        still needed wants one of its resources."""
+        needed = set(missing)
+        picked = []
+        for step in reversed(plan):
+            if any(name in needed for name in step.provides):
+                picked.append(step)
+                needed.update(
+                    name for name in step.wants if not self.resource_ready(name)
+                )
+        picked.reverse()
+        return tuple(picked)
+
+    def compile(self):
+        """Precompute the provider closure for every registered step.
+
+        Call this once after all steps have been registered. Afterwards a
+        call-graph cache miss only filters the step's precompiled closure
+        against the store, instead of re-walking the provider edges."""
+        for target in self._steps.values():
+            order = []
+            seen = {target.fname}
+            stack = [(target, False)]
+            while stack:
+                step, expanded = stack.pop()
+                if expanded:
+                    order.append(step)
+                    continue
+                stack.append((step, True))
+                for name in step.wants:
+                    provider = self._provider.get(name)
+                    if provider is None or provider == _ENV or provider in seen:
+                        continue
+                    seen.add(provider)
+                    stack.append((self._steps[provider], False))
+            target._plan = tuple(order[:-1])
+
+    async def run(self, _target, **resources):
+        """Run a step and everything it depends on, returning its results.
+
+        {_target} is a Step or the name of one; the leading underscore keeps
+        it from colliding with a resource passed by keyword. Each step in the
+        call graph is scheduled as its own task, gated on an event that fires
+        once that step's own prerequisites have finished. A step therefore
+        starts as soon as it is able to, instead of waiting for every step in
+        its dependency level to complete."""
+        if isinstance(_target, str):
+            _target = self._steps[_target]
+        self.add_environment_resources(**resources)
+
+        order = self._call_graph(_target) + (_target,)
+
+        providers: Dict[str, Step] = {}
+        for step in order:
+            for name in step.provides:
+                providers.setdefault(name, step)
+
+        indegree: Dict[Step, int] = {}
+        dependents: Dict[Step, list] = defaultdict(list)
+        for step in order:
+            deps = {
+                providers[name]
+                for name in step.wants
+                if name in providers and providers[name] is not step
+            }
+            indegree[step] = len(deps)
+            for dep in deps:
+                dependents[dep].append(step)
+
+        # Scheduling state is local to this run; steps shared between
+        # overlapping runs must not clobber each other's gates.
+        ready: Dict[Step, asyncio.Event] = {}
+        for step in order:
+            event = ready[step] = asyncio.Event()
+            if indegree[step] == 0:
+                event.set()
+
+        async def run_step(step):
+            await ready[step].wait()
+            result = await self._execute_once(step)
+            for waiter in dependents[step]:
+                indegree[waiter] -= 1
+                if indegree[waiter] == 0:
+                    ready[waiter].set()
+            return result
+
+        # If a step raises, its dependents never get woken; cancel them so a
+        # failed run doesn't leave tasks parked on their events forever.
+        tasks = [asyncio.ensure_future(run_step(step)) for step in order]
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return results[-1]
+
+    def _execute_once(self, step) -> asyncio.Task:
+        """Get the in-flight task executing the step, starting one if needed.
+
+        Both the scheduler and the resource() fallback come through here, so
+        a step shared between overlapping runs only ever executes once; the
+        task removes itself on completion so a later rerun starts fresh."""
+        task = self._inflight.get(step.fname)
+        if task is None:
+            task = asyncio.ensure_future(step._execute())
+            self._inflight[step.fname] = task
+            task.add_done_callback(
+                lambda _, fname=step.fname: self._inflight.pop(fname, None)
+            )
+        return task
+
+    def _ensure_future(self, name) -> asyncio.Future:
+        """Get the Future for the named resource, creating it on first use."""
+        fut = self._store.get(name)
+        if fut is None:
+            fut = self._store[name] = asyncio.get_event_loop().create_future()
+        return fut
 
     def _add_returned_resources(self, _provider, **kwargs):
         """Add one or more named resources to the pipeline datastore."""
+        # Checked once up front so the loop doesn't even pack log arguments
+        # when debug logging is off.
+        log_debug = log.isEnabledFor(logging.DEBUG)
+        store = self._store
+        provider = self._provider
+        runtime = self._runtime_resources
         for k, v in kwargs.items():
-            self.log.debug("adding resource %s", k)
-            self._store[k].set_result(v)
-            self._provider[k] = _provider
+            if log_debug:
+                log.debug("adding resource %s", k)
+            fut = store.get(k)
+            if fut is None:
+                fut = store[k] = asyncio.get_event_loop().create_future()
+            fut.set_result(v)
+            # Providers are write-once; who can make a resource is decided at
+            # registration and doesn't flip when a value arrives at runtime.
+            provider.setdefault(k, _provider)
+            if _provider is not _ENV:
+                runtime.add(k)
 
     def add_environment_resources(self, **kwargs):
         self._add_returned_resources(_provider=_ENV, **kwargs)
 
     def resource_ready(self, name):
         """Check if the named resource is ready for use."""
-        return self._store[name].done()
+        fut = self._store.get(name)
+        return fut is not None and fut.done()
 
     async def resource(self, name):
         """Get a resource from the store, blocking until it is ready to use."""
-        if not self._store[name].done() and self._provider[name] != _ENV:
-            self.log.debug("waiting for %s to become available", name)
-            await self._steps[self._provider[name]]()
-        return await self._store[name]
+        fut = self._ensure_future(name)
+        if fut.done():
+            return fut.result()
+        provider = self._provider[name]
+        if provider != _ENV:
+            log.debug("waiting for %s to become available", name)
+            await self._execute_once(self._steps[provider])
+        return await fut
 
     def clear(self):
         """Remove all runtime-provided resources from the store."""
-        for resource, provider in self._provider.items():
-            if provider == _ENV:
-                continue
-            del self._store[resource]
+        for resource in self._runtime_resources:
+            self._store.pop(resource, None)
+        self._runtime_resources.clear()
+        # Removing resources is the one thing that can grow a call graph
+        # again, so the per-step memoized orders are stale now. The keyed
+        # cache has to go too: its keys only cover the target's own missing
+        # wants, so entries computed while deeper dependencies were resolved
+        # would replay orders with those providers missing.
+        self._graph_cache.clear()
+        for step in self._steps.values():
+            step._order = None
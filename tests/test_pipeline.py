@@ -0,0 +1,130 @@
+import asyncio
+
+import aiounittest
+
+from pipeliner.pipeliner import Pipeline
+
+
+def chain_pipeline():
+    """A four-step chain: x -> a -> b -> t, with b also wanting x."""
+    pipe = Pipeline()
+    calls = []
+
+    @pipe.step(provides="x")
+    async def make_x():
+        calls.append("make_x")
+        return 1
+
+    @pipe.step(provides="a")
+    async def make_a(x):
+        calls.append("make_a")
+        return x + 1
+
+    @pipe.step(provides="b")
+    async def make_b(x, a):
+        calls.append("make_b")
+        return x + a
+
+    @pipe.step(provides="t")
+    async def make_t(b):
+        calls.append("make_t")
+        return b + 1
+
+    return pipe, calls, make_a, make_t
+
+
+class SharedProviderTest(aiounittest.AsyncTestCase):
+    async def test_concurrent_targets_run_shared_providers_once(self):
+        # Two targets racing over the same a -> b chain must not execute
+        # the shared providers twice.
+        pipe = Pipeline()
+        calls = []
+
+        @pipe.step(provides="a")
+        async def make_a():
+            calls.append("make_a")
+            await asyncio.sleep(0.01)
+            return 1
+
+        @pipe.step(provides="b")
+        async def make_b(a):
+            calls.append("make_b")
+            await asyncio.sleep(0.01)
+            return a + 1
+
+        @pipe.step(provides="t1")
+        async def t1(b):
+            return b + 1
+
+        @pipe.step(provides="t2")
+        async def t2(b):
+            return b + 10
+
+        r1, r2 = await asyncio.gather(t1(), t2())
+        self.assertEqual(r1, (3,))
+        self.assertEqual(r2, (12,))
+        self.assertEqual(calls, ["make_a", "make_b"])
+
+
+class IntrospectionTest(aiounittest.AsyncTestCase):
+    def test_step_exposes_wrapped_function_metadata(self):
+        pipe = Pipeline()
+
+        @pipe.step(provides="thing")
+        async def make_thing():
+            """Produce the thing."""
+            return 1
+
+        self.assertEqual(make_thing.__name__, "make_thing")
+        self.assertEqual(make_thing.__doc__, "Produce the thing.")
+        self.assertIs(make_thing.__wrapped__, make_thing.func)
+
+
+class FailingStepTest(aiounittest.AsyncTestCase):
+    async def test_failing_step_does_not_leak_pending_tasks(self):
+        # A step that raises must not strand its dependents' scheduler
+        # tasks on events that will never fire.
+        pipe = Pipeline()
+
+        @pipe.step(provides="a")
+        async def make_a():
+            raise RuntimeError("boom")
+
+        @pipe.step(provides="t")
+        async def make_t(a):
+            return a
+
+        for _ in range(3):
+            with self.assertRaises(RuntimeError):
+                await make_t()
+
+        pending = [
+            task
+            for task in asyncio.all_tasks()
+            if task is not asyncio.current_task()
+        ]
+        self.assertEqual(pending, [])
+
+
+class ClearTest(aiounittest.AsyncTestCase):
+    async def test_rerun_after_clear_rebuilds_call_graph(self):
+        # A call graph resolved while deep dependencies were in the store
+        # must not be replayed after clear() has emptied it again.
+        pipe, calls, make_a, make_t = chain_pipeline()
+
+        await make_a()
+        self.assertEqual(await make_t(), (4,))
+        pipe.clear()
+        self.assertEqual(await make_t(), (4,))
+        self.assertEqual(calls.count("make_x"), 2)
+        self.assertEqual(calls.count("make_t"), 2)
+
+    async def test_clear_keeps_environment_resources(self):
+        pipe, calls, make_a, make_t = chain_pipeline()
+
+        pipe.add_environment_resources(x=10)
+        self.assertEqual(await make_t(), (22,))
+        pipe.clear()
+        self.assertTrue(pipe.resource_ready("x"))
+        self.assertEqual(await make_t(), (22,))
+        self.assertNotIn("make_x", calls)